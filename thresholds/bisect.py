@@ -1,5 +1,4 @@
 import numpy as np
-from tqdm import tqdm
 
 
 def probabilistic_bisection(noisy_oracle, search_interval=(0, 1), p=0.6, max_iterations=1000, resolution=100000,
@@ -75,6 +74,8 @@ def probabilistic_bisection(noisy_oracle, search_interval=(0, 1), p=0.6, max_ite
             median, fraction * 100, left, right)
         return description
 
+    from tqdm import tqdm
+
     trange = tqdm(range(max_iterations))
     for _ in trange:
         f = fs[-1]
@@ -1,7 +1,10 @@
-from simtk import unit
+def _default_potential_energy_threshold():
+    """1000 kJ/mol, constructed on first use so that importing this module doesn't import OpenMM"""
+    from simtk import unit
+    return 1000 * unit.kilojoule_per_mole
 
 
-def check_stability(simulation, n_steps=1000, n_rounds=10, potential_energy_threshold=1000 * unit.kilojoule_per_mole):
+def check_stability(simulation, n_steps=1000, n_rounds=10, potential_energy_threshold=None):
     """Run simulation for n_steps, periodically checking if the potential energy exceeds a threshold.
     If the potential energy ever exceeds the threshold or becomes NaN, terminate and return False.
     
@@ -14,10 +17,12 @@ def check_stability(simulation, n_steps=1000, n_rounds=10, potential_energy_thre
     n_rounds : int, default 10
         how many rounds to use to run n_steps
         e.g. if n_steps is 1000, specifying n_rounds as 10 will run 10 rounds of 100 steps
-    potential_energy_threshold : simtk.unit (energy)
+    potential_energy_threshold : simtk.unit (energy), default 1000 kJ/mol
         if the potential energy of the simulation exceeds this threshold, NaNs are nigh
 
     """
+    if potential_energy_threshold is None:
+        potential_energy_threshold = _default_potential_energy_threshold()
 
     for _ in range(n_rounds):
         simulation.step(round(n_steps / n_rounds))
@@ -28,7 +33,7 @@ def check_stability(simulation, n_steps=1000, n_rounds=10, potential_energy_thre
 
 
 def stability_oracle_factory(simulation, set_initial_conditions,
-                             n_steps=1000, potential_energy_threshold=1000 * unit.kilojoule_per_mole):
+                             n_steps=1000, potential_energy_threshold=None):
     """Construct a stochastic function that accepts a scalar (timestep, in femtoseconds)
     and checks whether integration at that timestep appears stable.
 
@@ -41,7 +46,7 @@ def stability_oracle_factory(simulation, set_initial_conditions,
         may set state to a sample from equilibrium, or from some other interesting ensemble of initial conditions.
     n_steps : int
         how many timesteps to simulate
-    potential_energy_threshold : simtk.unit (energy)
+    potential_energy_threshold : simtk.unit (energy), default 1000 kJ/mol
         if the potential energy of the simulation exceeds this threshold, NaNs are nigh
 
     Returns
@@ -49,6 +54,10 @@ def stability_oracle_factory(simulation, set_initial_conditions,
     iterated_stability_oracle : callable
         accepts dt (float) and n_iterations (int)
     """
+    from simtk import unit
+
+    if potential_energy_threshold is None:
+        potential_energy_threshold = _default_potential_energy_threshold()
 
     def stability_oracle(dt):
         """Sample whether the simulation blows up at the given timestep dt"""
@@ -61,7 +70,7 @@ def stability_oracle_factory(simulation, set_initial_conditions,
 
         set_initial_conditions(simulation)
 
-        return check_stability(simulation, n_steps, potential_energy_threshold)
+        return check_stability(simulation, n_steps, potential_energy_threshold=potential_energy_threshold)
 
     def iterated_stability_oracle(dt, n_iterations=10):
         """Return True if stability_oracle is True n_iterations times, terminating early when possible.
@@ -0,0 +1,40 @@
+import json
+import subprocess
+import sys
+
+# modules that should only be imported when a simulation is actually constructed or a search actually runs
+heavy_modules = ['simtk', 'openmm', 'openmmtools', 'tqdm']
+
+# importing the package on top of numpy costs ~0.15x importing numpy itself, while re-adding a top-level
+# `from simtk import openmm` pushes this to ~0.8x (and openmmtools to over 10x)
+max_import_time_ratio = 0.3
+
+lightweight_import = """
+import json, sys, time
+start = time.perf_counter()
+import numpy
+baseline = time.perf_counter() - start
+start = time.perf_counter()
+import thresholds.bisect, thresholds.error, thresholds.stability, thresholds.utils, thresholds.workqueue
+elapsed = time.perf_counter() - start
+print(json.dumps({'baseline': baseline, 'elapsed': elapsed,
+                  'modules': sorted(set(name.split('.')[0] for name in sys.modules))}))
+"""
+
+
+def measure_lightweight_import():
+    output = subprocess.check_output([sys.executable, '-c', lightweight_import], universal_newlines=True)
+    return json.loads(output)
+
+
+def test_imports_are_lightweight():
+    # check that importing the package doesn't drag in OpenMM, openmmtools or tqdm
+    measurement = measure_lightweight_import()
+    loaded = [name for name in heavy_modules if name in measurement['modules']]
+    assert (loaded == [])
+
+    # check that import time hasn't regressed, relative to importing numpy in the same interpreter
+    # (best of a few, to be robust to a cold filesystem cache)
+    measurements = [measurement] + [measure_lightweight_import() for _ in range(2)]
+    ratio = min(m['elapsed'] / m['baseline'] for m in measurements)
+    assert (ratio < max_import_time_ratio)
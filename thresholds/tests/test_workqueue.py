@@ -0,0 +1,180 @@
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from thresholds import workqueue
+
+system_spec = {'name': 'AlanineDipeptideVacuum', 'kwargs': {}}
+integrator_spec = {'name': 'LangevinIntegrator', 'kwargs': {'timestep': {'value': 1.0, 'unit': 'femtosecond'}}}
+
+
+def test_submit_claim_complete(tmpdir):
+    queue = workqueue.WorkQueue(str(tmpdir.join('queue.sqlite')))
+    job_id = queue.submit(system_spec, integrator_spec, 2.5, {'n_iterations': 1}, search_id='a')
+    assert (queue.status(job_id) == 'pending')
+
+    claimed_id, payload = queue.claim('worker-a')
+    assert (claimed_id == job_id)
+    assert (payload['dt'] == 2.5)
+    assert (payload['system_spec'] == system_spec)
+    assert (payload['trial_config'] == {'n_iterations': 1})
+
+    # the job is leased to worker-a
+    assert (queue.status(job_id) == 'running')
+
+    # nothing else to claim while the lease is held
+    assert (queue.claim('worker-b') is None)
+
+    # only the lease holder can report a result
+    assert (not queue.complete(job_id, 'worker-b', False))
+    assert (queue.complete(job_id, 'worker-a', True))
+    assert (queue.wait(job_id, poll_interval=0.01) is True)
+    assert (queue.counts('a') == {'done': 1})
+
+    with pytest.raises(KeyError):
+        queue.status(job_id + 1)
+
+
+def test_expired_lease_is_reclaimed(tmpdir):
+    queue = workqueue.WorkQueue(str(tmpdir.join('queue.sqlite')), lease_duration=0.05, max_attempts=2)
+    job_id = queue.submit(system_spec, integrator_spec, 1.0)
+
+    # worker-a claims the job, then "crashes"
+    assert (queue.claim('worker-a')[0] == job_id)
+    time.sleep(0.1)
+
+    # worker-b picks it up, and worker-a can no longer report on it
+    assert (queue.claim('worker-b')[0] == job_id)
+    assert (not queue.renew(job_id, 'worker-a'))
+    assert (queue.renew(job_id, 'worker-b'))
+
+    # once worker-b also crashes, the job has used up its attempts
+    time.sleep(0.1)
+    assert (queue.claim('worker-c') is None)
+    assert (queue.status(job_id) == 'failed')
+    with pytest.raises(RuntimeError):
+        queue.wait(job_id, poll_interval=0.01)
+
+    with pytest.raises(ValueError):
+        workqueue.WorkQueue(str(tmpdir.join('queue.sqlite')), max_attempts=0)
+
+
+def test_run_worker(tmpdir):
+    path = str(tmpdir.join('queue.sqlite'))
+    queue = workqueue.WorkQueue(path, max_attempts=2)
+
+    # two concurrent searches sharing the queue
+    job_ids = [queue.submit(system_spec, integrator_spec, dt, search_id=search_id)
+               for dt in [1.0, 2.0, 3.0] for search_id in ['a', 'b']]
+
+    attempts = []
+
+    def flaky_run_job(payload):
+        # fail the first attempt at dt=3.0, to check that errors are retried
+        attempts.append(payload['dt'])
+        if payload['dt'] == 3.0 and attempts.count(3.0) == 1:
+            raise (RuntimeError('worker fell over'))
+        return payload['dt'] < 2.5
+
+    n_jobs = workqueue.run_worker(workqueue.WorkQueue(path), 'worker-a', run_job=flaky_run_job,
+                                  exit_when_idle=True)
+    assert (n_jobs == 7)
+    assert ([queue.wait(job_id, poll_interval=0.01) for job_id in job_ids] == [True, True, True, True, False, False])
+    assert (queue.counts() == {'done': 6})
+
+    # jobs that keep failing are eventually marked failed
+    def broken_run_job(payload):
+        raise (RuntimeError('worker fell over'))
+
+    job_id = queue.submit(system_spec, integrator_spec, 1.0)
+    assert (workqueue.run_worker(queue, run_job=broken_run_job, exit_when_idle=True) == 2)
+    with pytest.raises(RuntimeError):
+        queue.wait(job_id, poll_interval=0.01)
+
+    # results that can't be stored are job errors, rather than crashing the worker
+    def unserializable_run_job(payload):
+        return {True}
+
+    job_id = queue.submit(system_spec, integrator_spec, 1.0)
+    assert (workqueue.run_worker(queue, run_job=unserializable_run_job, exit_when_idle=True) == 2)
+    with pytest.raises(RuntimeError, match='TypeError'):
+        queue.wait(job_id, poll_interval=0.01)
+
+
+def test_run_worker_lost_lease(tmpdir):
+    path = str(tmpdir.join('queue.sqlite'))
+    queue = workqueue.WorkQueue(path, lease_duration=0.06)
+    job_id = queue.submit(system_spec, integrator_spec, 1.0)
+
+    def hijacked_run_job(payload):
+        # another worker takes over the lease while this one is still simulating
+        connection = sqlite3.connect(path, isolation_level=None)
+        connection.execute("UPDATE jobs SET worker = 'worker-b'")
+        connection.close()
+        time.sleep(0.1)
+        return True
+
+    # check that both the heartbeat and the discarded result are reported
+    with pytest.warns(RuntimeWarning) as record:
+        workqueue.run_worker(queue, 'worker-a', run_job=hijacked_run_job, max_jobs=1)
+    messages = [str(warning.message) for warning in record]
+    assert (any('lost its lease' in message for message in messages))
+    assert (any('discarded its outcome' in message for message in messages))
+
+    # the result was not recorded under worker-b's lease
+    assert (queue.status(job_id) == 'running')
+
+
+def test_queued_oracle_factory(tmpdir):
+    queue = workqueue.WorkQueue(str(tmpdir.join('queue.sqlite')))
+    noisy_oracle = workqueue.queued_oracle_factory(queue, system_spec, integrator_spec, search_id='a',
+                                                   poll_interval=0.01, timeout=10)
+
+    # with no workers around, waiting times out
+    with pytest.raises(TimeoutError):
+        queue.wait(queue.submit(system_spec, integrator_spec, 1.0), poll_interval=0.01, timeout=0.05)
+    with pytest.raises(TimeoutError):
+        workqueue.queued_oracle_factory(queue, system_spec, integrator_spec, poll_interval=0.01, timeout=0.05)(1.0)
+
+    # serve the oracle's job (and the two left over above) from a background worker,
+    # which needs its own connection since sqlite3 connections can't be shared across threads
+    def serve():
+        workqueue.run_worker(workqueue.WorkQueue(queue.path), 'worker-a', run_job=lambda payload: payload['dt'] < 2.0,
+                             poll_interval=0.01, max_jobs=3)
+
+    worker = threading.Thread(target=serve, daemon=True)
+    worker.start()
+    assert (noisy_oracle(1.5))
+    worker.join(timeout=10)
+    assert (not worker.is_alive())
+    assert (queue.counts('a') == {'done': 1})
+
+
+def test_run_oracle_job(tmpdir):
+    # imported here rather than at the top, so the queue tests above still run without OpenMM
+    from openmmtools import integrators
+    from simtk import unit
+
+    # check that {'value': ..., 'unit': ...} kwargs are converted to quantities
+    integrator = workqueue._build(integrators, {'name': 'LangevinIntegrator', 'kwargs': {
+        'timestep': {'value': 0.5, 'unit': 'femtosecond'}, 'temperature': {'value': 310.0, 'unit': 'kelvin'}}})
+    assert (integrator.getStepSize() == 0.5 * unit.femtosecond)
+    assert (integrator.getTemperature() == 310.0 * unit.kelvin)
+
+    # run a tiny and a huge timestep through a worker using the default run_oracle_job
+    queue = workqueue.WorkQueue(str(tmpdir.join('queue.sqlite')))
+    trial_config = {'n_steps': 100, 'n_iterations': 2}
+    stable_id = queue.submit(system_spec, integrator_spec, 0.1, trial_config)
+    unstable_id = queue.submit(system_spec, integrator_spec, 100.0, trial_config)
+
+    workqueue._oracle_cache.clear()
+    assert (workqueue.run_worker(queue, 'worker-a', max_jobs=1) == 1)
+    oracle = workqueue._oracle_cache[workqueue._spec_key(system_spec, integrator_spec, trial_config)]
+    assert (workqueue.run_worker(queue, 'worker-a', exit_when_idle=True) == 1)
+    assert (queue.wait(stable_id, poll_interval=0.01, timeout=0) is True)
+    assert (queue.wait(unstable_id, poll_interval=0.01, timeout=0) is False)
+
+    # check that the second job reused the simulation built for the first
+    assert (list(workqueue._oracle_cache.values()) == [oracle])
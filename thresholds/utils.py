@@ -1,7 +1,3 @@
-from simtk import openmm as mm
-from simtk.openmm import app
-
-
 def clone_state(source_sim, target_sim):
     """Clone the state of source_sim to target_sim, where state = (positions, box-vectors, velocities)"""
     source_state = source_sim.context.getState(getPositions=True, getVelocities=True)
@@ -28,6 +24,8 @@ def measure_shadow_work(sim, n_steps):
 def sim_factory(testsystem, platform=None):
     """Convenience method for constructing multiple simulations using the same openmmtools testsystem
     but different integrators"""
+    from simtk import openmm as mm
+    from simtk.openmm import app
 
     if not isinstance(platform, mm.Platform):
         platform = mm.Platform.getPlatformByName("Reference")
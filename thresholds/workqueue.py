@@ -0,0 +1,395 @@
+"""SQLite-backed work queue for sharing oracle evaluations across processes and nodes.
+
+Search drivers submit stability-oracle jobs (system spec, integrator spec, dt, trial config) to a queue file on a
+shared filesystem, and standalone worker processes claim and run them. Claims are time-limited leases, renewed in the
+background while a job runs: if a worker crashes, its lease expires and the job is handed to another worker, up to
+max_attempts times.
+
+Caveat: claims rely on SQLite's file locking, which is unreliable on NFS and many other network filesystems. There,
+two workers can claim the same job at once and both run it. What stays safe: only the current lease holder can renew a
+job or record its result, so a job gets a single recorded result, and a result from a worker whose lease was taken over
+is rejected. Expect some duplicated work on such filesystems. Prefer a local filesystem, or one whose POSIX locks are
+known to work (e.g. Lustre mounted with flock), when many workers poll the same queue.
+
+Caveat: each node stamps leases with its own wall clock, and other nodes judge expiry with theirs, so the nodes' clocks
+must agree (e.g. via NTP) to well under lease_duration. A node whose clock runs ahead by about lease_duration takes over
+jobs that are still running. Taking the time from SQL (julianday('now')) would not help, since SQLite runs inside each
+process and reads that node's clock.
+
+Specs are JSON-serializable dicts naming an openmmtools class and its keyword arguments, e.g.
+    system_spec = {'name': 'AlanineDipeptideVacuum', 'kwargs': {'constraints': None}}
+    integrator_spec = {'name': 'LangevinIntegrator', 'kwargs': {'splitting': 'V R O R V'}}
+Keyword arguments that carry units are written as {'value': 300.0, 'unit': 'kelvin'}.
+
+Usage
+-----
+    # on each node
+    python -m thresholds.workqueue /shared/path/queue.sqlite
+
+    # in a search driver
+    queue = WorkQueue('/shared/path/queue.sqlite')
+    noisy_oracle = queued_oracle_factory(queue, system_spec, integrator_spec, trial_config={'n_iterations': 20})
+    x, zs, fs = bisect.probabilistic_bisection(noisy_oracle, search_interval=(0, 10), p=0.8)
+"""
+
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import warnings
+
+PENDING, RUNNING, DONE, FAILED = 'pending', 'running', 'done', 'failed'
+
+_schema = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    search_id TEXT,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    worker TEXT,
+    lease_expires REAL,
+    result TEXT,
+    error TEXT,
+    submitted REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id);
+"""
+
+
+class WorkQueue(object):
+    """Persistent queue of oracle jobs, stored in a single SQLite file.
+
+    Parameters
+    ----------
+        path : str
+            location of the SQLite database; must be on a filesystem visible to all submitters and workers.
+            On NFS and similar filesystems SQLite's locks are unreliable and a job may be claimed twice (see the
+            module docstring); only the lease holder can still renew it or record its result
+        lease_duration : float
+            seconds a worker may hold a job without renewing its lease before the job is considered abandoned.
+            Clocks on all nodes must agree to well under this (see the module docstring)
+        max_attempts : int
+            how many times a job may be claimed before it is marked failed. The limit is stored with each job when it
+            is submitted, so it only applies to jobs submitted through this instance; a worker's setting has no effect
+        timeout : float
+            seconds to wait on a locked database before raising sqlite3.OperationalError
+    """
+
+    def __init__(self, path, lease_duration=600.0, max_attempts=3, timeout=60.0):
+        if max_attempts < 1:
+            raise (ValueError('max_attempts must be a positive integer'))
+        self.path = path
+        self.lease_duration = lease_duration
+        self.max_attempts = max_attempts
+        self._connection = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        self._connection.executescript(_schema)
+
+    def close(self):
+        self._connection.close()
+
+    def _transaction(self):
+        """Take the write lock up front, so that claims from concurrent workers can't interleave."""
+        self._connection.execute('BEGIN IMMEDIATE')
+        return self._connection
+
+    def submit(self, system_spec, integrator_spec, dt, trial_config=None, search_id=None):
+        """Enqueue a stability-oracle evaluation at timestep dt (in femtoseconds) and return its job id."""
+        payload = dict(system_spec=system_spec, integrator_spec=integrator_spec, dt=float(dt),
+                       trial_config=trial_config or {})
+        cursor = self._connection.execute(
+            'INSERT INTO jobs (search_id, payload, status, max_attempts, submitted) VALUES (?, ?, ?, ?, ?)',
+            (search_id, json.dumps(payload, sort_keys=True), PENDING, self.max_attempts, time.time()))
+        return cursor.lastrowid
+
+    def claim(self, worker_id):
+        """Lease the oldest available job to worker_id.
+
+        A job is available if it is pending, or if it is running under an expired lease (its worker presumably
+        crashed). Jobs whose expired lease used up their last attempt are marked failed instead.
+
+        Returns
+        -------
+            job : (int, dict) or None
+                job id and payload, or None if no job is available
+        """
+        now = time.time()
+        connection = self._transaction()
+        try:
+            connection.execute(
+                'UPDATE jobs SET status = ?, error = ?, worker = NULL, lease_expires = NULL '
+                'WHERE status = ? AND lease_expires < ? AND attempts >= max_attempts',
+                (FAILED, 'lease expired', RUNNING, now))
+            row = connection.execute(
+                'SELECT id, payload FROM jobs WHERE status = ? OR (status = ? AND lease_expires < ?) '
+                'ORDER BY id LIMIT 1', (PENDING, RUNNING, now)).fetchone()
+            if row is not None:
+                connection.execute(
+                    'UPDATE jobs SET status = ?, worker = ?, lease_expires = ?, attempts = attempts + 1 '
+                    'WHERE id = ?', (RUNNING, worker_id, now + self.lease_duration, row[0]))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def _update_leased(self, job_id, worker_id, assignments, values):
+        """Update a job only if worker_id still holds its lease. Returns whether the update happened."""
+        cursor = self._connection.execute(
+            'UPDATE jobs SET {} WHERE id = ? AND status = ? AND worker = ?'.format(assignments),
+            tuple(values) + (job_id, RUNNING, worker_id))
+        return cursor.rowcount == 1
+
+    def renew(self, job_id, worker_id):
+        """Extend worker_id's lease on job_id. Returns False if the lease was lost to another worker."""
+        return self._update_leased(job_id, worker_id, 'lease_expires = ?', (time.time() + self.lease_duration,))
+
+    def complete(self, job_id, worker_id, result):
+        """Record the (JSON-serializable) result of job_id. Returns False if the lease was lost to another worker."""
+        return self._update_leased(job_id, worker_id, 'status = ?, result = ?, lease_expires = NULL',
+                                   (DONE, json.dumps(result)))
+
+    def fail(self, job_id, worker_id, error):
+        """Release job_id after an error, re-queueing it unless it has used up its attempts."""
+        return self._update_leased(
+            job_id, worker_id,
+            'status = CASE WHEN attempts >= max_attempts THEN ? ELSE ? END, error = ?, worker = NULL, '
+            'lease_expires = NULL', (FAILED, PENDING, str(error)))
+
+    def status(self, job_id):
+        """Return the status of job_id: one of 'pending', 'running', 'done', 'failed'."""
+        row = self._connection.execute('SELECT status FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            raise (KeyError('no job with id {}'.format(job_id)))
+        return row[0]
+
+    def counts(self, search_id=None):
+        """Return a dict mapping status to number of jobs, optionally restricted to one search."""
+        if search_id is None:
+            rows = self._connection.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status')
+        else:
+            rows = self._connection.execute('SELECT status, COUNT(*) FROM jobs WHERE search_id = ? GROUP BY status',
+                                            (search_id,))
+        return dict(rows.fetchall())
+
+    def wait(self, job_id, poll_interval=1.0, timeout=None):
+        """Block until job_id is done and return its result.
+
+        Raises
+        ------
+            RuntimeError
+                if the job failed on every attempt
+            TimeoutError
+                if the job isn't finished after timeout seconds
+        """
+        start = time.time()
+        while True:
+            row = self._connection.execute('SELECT status, result, error FROM jobs WHERE id = ?',
+                                           (job_id,)).fetchone()
+            if row is None:
+                raise (KeyError('no job with id {}'.format(job_id)))
+            status, result, error = row
+            if status == DONE:
+                return json.loads(result)
+            if status == FAILED:
+                raise (RuntimeError('job {} failed: {}'.format(job_id, error)))
+            if (timeout is not None) and (time.time() - start > timeout):
+                raise (TimeoutError('job {} not finished after {}s'.format(job_id, timeout)))
+            time.sleep(poll_interval)
+
+
+def queued_oracle_factory(queue, system_spec, integrator_spec, trial_config=None, search_id=None,
+                          poll_interval=1.0, timeout=None):
+    """Construct a noisy oracle that accepts a scalar (timestep, in femtoseconds) and evaluates it on the queue's
+    workers, blocking until a worker reports the result.
+
+    Parameters
+    ----------
+        queue : WorkQueue
+            queue shared with the workers
+        system_spec : dict
+            openmmtools testsystem to simulate, as {'name': ..., 'kwargs': {...}}
+        integrator_spec : dict
+            openmmtools integrator to test, as {'name': ..., 'kwargs': {...}}
+        trial_config : dict
+            options for run_oracle_job: n_steps, n_iterations, potential_energy_threshold (in kJ/mol)
+        search_id : str
+            label attached to submitted jobs, for monitoring with queue.counts(search_id)
+        poll_interval : float
+            seconds between checks for the result
+        timeout : float
+            if not None, raise TimeoutError when a job isn't finished after this many seconds, rather than blocking
+            forever when no workers are alive
+
+    Returns
+    -------
+        noisy_oracle : callable
+            accepts dt (float) and returns a bool, suitable for bisect.probabilistic_bisection
+    """
+
+    def noisy_oracle(dt):
+        job_id = queue.submit(system_spec, integrator_spec, dt, trial_config, search_id=search_id)
+        return queue.wait(job_id, poll_interval=poll_interval, timeout=timeout)
+
+    return noisy_oracle
+
+
+def _build(module, spec):
+    """Instantiate spec['name'] from module, converting {'value': ..., 'unit': ...} kwargs to simtk quantities."""
+    from simtk import unit
+
+    kwargs = {}
+    for key, value in spec.get('kwargs', {}).items():
+        if isinstance(value, dict) and set(value) == {'value', 'unit'}:
+            value = value['value'] * getattr(unit, value['unit'])
+        kwargs[key] = value
+    return getattr(module, spec['name'])(**kwargs)
+
+
+def _spec_key(*specs):
+    return json.dumps(specs, sort_keys=True)
+
+
+_oracle_cache = {}
+
+
+def run_oracle_job(payload):
+    """Run the stability oracle described by a job payload and return its (bool) result.
+
+    The simulation is built with utils.sim_factory and evaluated with stability.stability_oracle_factory, starting
+    each trial from the testsystem's positions with velocities drawn at the integrator's temperature.
+    Oracles are cached per (system spec, integrator spec, trial config), so a worker serving one search only
+    constructs its simulation once.
+    """
+    from openmmtools import integrators, testsystems
+    from simtk import unit
+
+    from .stability import stability_oracle_factory
+    from .utils import sim_factory
+
+    trial_config = payload['trial_config']
+    key = _spec_key(payload['system_spec'], payload['integrator_spec'], trial_config)
+    if key not in _oracle_cache:
+        testsystem = _build(testsystems, payload['system_spec'])
+        simulation = sim_factory(testsystem)(_build(integrators, payload['integrator_spec']))
+
+        def set_initial_conditions(sim):
+            sim.context.setPositions(testsystem.positions)
+            sim.context.setVelocitiesToTemperature(sim.integrator.getTemperature())
+
+        # only keep the most recent simulation alive, so a worker hopping between searches doesn't hoard contexts
+        _oracle_cache.clear()
+        _oracle_cache[key] = stability_oracle_factory(
+            simulation, set_initial_conditions, n_steps=trial_config.get('n_steps', 1000),
+            potential_energy_threshold=trial_config.get('potential_energy_threshold', 1000)
+                                       * unit.kilojoule_per_mole)
+
+    return _oracle_cache[key](payload['dt'], n_iterations=trial_config.get('n_iterations', 10))
+
+
+def default_worker_id():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def _keep_leased(queue, job_id, worker_id, stop):
+    """Renew the lease on job_id every third of a lease_duration until stop is set, warning if the lease is lost."""
+    heartbeat_queue = WorkQueue(queue.path, lease_duration=queue.lease_duration)
+    try:
+        while not stop.wait(queue.lease_duration / 3):
+            try:
+                renewed = heartbeat_queue.renew(job_id, worker_id)
+            except sqlite3.OperationalError as e:
+                # e.g. the database stayed locked past its timeout; keep trying until the lease actually expires
+                warnings.warn('worker {} could not renew its lease on job {}: {}'.format(worker_id, job_id, e),
+                              RuntimeWarning)
+                continue
+            if not renewed:
+                warnings.warn('worker {} lost its lease on job {}; its result will be discarded'.format(
+                    worker_id, job_id), RuntimeWarning)
+                break
+    finally:
+        heartbeat_queue.close()
+
+
+def run_worker(queue, worker_id=None, run_job=run_oracle_job, poll_interval=1.0, max_jobs=None, exit_when_idle=False):
+    """Claim and run jobs from queue until interrupted.
+
+    Parameters
+    ----------
+        queue : WorkQueue
+            queue to pull jobs from
+        worker_id : str
+            identifies this worker's leases; defaults to hostname:pid
+        run_job : callable
+            accepts a job payload and returns a JSON-serializable result
+        poll_interval : float
+            seconds to sleep when the queue is empty
+        max_jobs : int
+            if not None, stop after this many jobs
+        exit_when_idle : bool
+            if True, stop as soon as the queue is empty instead of polling
+
+    Returns
+    -------
+        n_jobs : int
+            number of jobs this worker ran
+    """
+    if worker_id is None:
+        worker_id = default_worker_id()
+
+    n_jobs = 0
+    while (max_jobs is None) or (n_jobs < max_jobs):
+        job = queue.claim(worker_id)
+        if job is None:
+            if exit_when_idle:
+                break
+            time.sleep(poll_interval)
+            continue
+
+        job_id, payload = job
+        n_jobs += 1
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=_keep_leased, args=(queue, job_id, worker_id, stop), daemon=True)
+        heartbeat.start()
+        try:
+            result = run_job(payload)
+            # fail the job here, rather than crashing the worker in queue.complete, if e.g. a numpy.bool_ slipped out
+            json.dumps(result)
+        except Exception as e:
+            error = '{}: {}'.format(type(e).__name__, e)
+            result = None
+        else:
+            error = None
+        finally:
+            stop.set()
+            heartbeat.join()
+
+        if error is not None:
+            recorded = queue.fail(job_id, worker_id, error)
+        else:
+            recorded = queue.complete(job_id, worker_id, result)
+        if not recorded:
+            warnings.warn('worker {} no longer holds the lease on job {}; discarded its outcome ({})'.format(
+                worker_id, job_id, error if error is not None else 'result {}'.format(result)), RuntimeWarning)
+    return n_jobs
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='Run oracle jobs from a shared work queue.')
+    parser.add_argument('path', help='path to the SQLite queue file')
+    parser.add_argument('--lease-duration', type=float, default=600.0,
+                        help='seconds before a silent worker\'s job is handed to another worker')
+    parser.add_argument('--poll-interval', type=float, default=1.0)
+    parser.add_argument('--max-jobs', type=int, default=None)
+    parser.add_argument('--exit-when-idle', action='store_true')
+    args = parser.parse_args()
+
+    run_worker(WorkQueue(args.path, lease_duration=args.lease_duration),
+               poll_interval=args.poll_interval, max_jobs=args.max_jobs, exit_when_idle=args.exit_when_idle)